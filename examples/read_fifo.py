@@ -5,25 +5,111 @@ from mpu6886 import MPU6886
 import time
 import struct
 import array
+import micropython
     
 
-def empty_array(typecode, length, value=0):
-    return array.array(typecode, (value for _ in range(length)))
+def empty_array(typecode, length):
+    return array.array(typecode, bytes(length * struct.calcsize(typecode)))
     
+@micropython.viper
+def isum(arr: ptr16, length: int) -> int:
+    # ptr16 reads are unsigned, sign-extend to get int16
+    s = 0
+    for i in range(length):
+        v = arr[i]
+        if v >= 0x8000:
+            v -= 0x10000
+        s += v
+    return s
+
 def mean(arr):
-    m = sum(arr) / float(len(arr))
+    m = isum(arr, len(arr)) / len(arr)
     return m
 
+class AccelerometerWindower:
+    """
+    Sliding window over X,Y,Z int16 samples
+
+    Uses fixed-size ring buffers, so pushing a hop does not allocate
+    or move the rest of the window.
+    """
+    def __init__(self, length, hop):
+        assert hop <= length
+        self.length = length
+        self.hop = hop
+        self.buf_x = empty_array('h', length)
+        self.buf_y = empty_array('h', length)
+        self.buf_z = empty_array('h', length)
+        self._views = (memoryview(self.buf_x),
+            memoryview(self.buf_y), memoryview(self.buf_z))
+        self.pos = 0 # index where the next hop is written
+        self.samples = 0 # number of valid samples, up to length
+
+    @property
+    def full(self):
+        return self.samples == self.length
+
+    def push(self, chunk_x, chunk_y, chunk_z):
+        """
+        Add one hop of samples, replacing the oldest ones
+        """
+        hop = self.hop
+        assert len(chunk_x) == hop
+        assert len(chunk_y) == hop
+        assert len(chunk_z) == hop
+
+        start = self.pos
+        end = start + hop
+        if end <= self.length:
+            self.buf_x[start:end] = chunk_x
+            self.buf_y[start:end] = chunk_y
+            self.buf_z[start:end] = chunk_z
+        else:
+            # wrap around the end of the buffers
+            first = self.length - start
+            rest = hop - first
+            for buf, chunk in zip(self._views, (chunk_x, chunk_y, chunk_z)):
+                chunk = memoryview(chunk)
+                buf[start:] = chunk[:first]
+                buf[:rest] = chunk[first:]
+
+        self.pos = end % self.length
+        self.samples = min(self.samples + hop, self.length)
+
+    def get_view(self):
+        """
+        Return (start, xs, ys, zs) for the current window
+
+        xs, ys, zs are memoryviews over the ring buffers,
+        with the oldest sample at index start.
+        Until the window is full, start is 0 and only the first
+        samples elements are valid.
+        NOTE: not a copy, contents change on the next push()
+        """
+        xs, ys, zs = self._views
+        start = self.pos if self.full else 0
+        return start, xs, ys, zs
+
+
 def main():
-    i2c = I2C(sda=21, scl=22, freq=100000)
+    i2c = I2C(sda=21, scl=22, freq=400000)
     mpu = MPU6886(i2c)
 
     # Enable FIFO at a fixed samplerate
+    odr = 100
     mpu.fifo_enable(True)
-    mpu.set_odr(100)
+    mpu.set_odr(odr)
+    sample_period_us = 1000000 // odr
 
     hop_length = 50
-    chunk = bytearray(mpu.bytes_per_sample*hop_length)
+    window_length = 2*hop_length
+    windower = AccelerometerWindower(window_length, hop_length)
+    # room for as many whole hops as the FIFO can hold
+    hop_bytes = mpu.bytes_per_sample*hop_length
+    max_hops = 1024 // hop_bytes
+    chunk = bytearray(hop_bytes*max_hops)
+    chunk_mv = memoryview(chunk)
+    hop_views = [chunk_mv[i*hop_bytes:(i+1)*hop_bytes] for i in range(max_hops)]
 
     x_values = empty_array('h', hop_length)
     y_values = empty_array('h', hop_length)
@@ -31,14 +117,22 @@ def main():
 
     while True:
 
-        count = mpu.get_fifo_count()
-        if count >= hop_length:
-            mpu.read_samples_into(chunk)
-            mpu.deinterleave_samples(chunk, x_values, y_values, z_values)
-            x, y, z = mean(x_values), mean(y_values), mean(z_values)
+        # drain all complete hops that are ready, in one burst
+        samples = mpu.read_available(chunk_mv, multiple=hop_length)
+        for hop in hop_views[:samples // hop_length]:
+            mpu.deinterleave_samples(hop, x_values, y_values, z_values)
+            windower.push(x_values, y_values, z_values)
+            if not windower.full:
+                continue
+
+            # order of samples does not matter for the mean
+            _, xs, ys, zs = windower.get_view()
+            x, y, z = mean(xs), mean(ys), mean(zs)
             print(f'xyz: \t{x:.0f} \t{y:.0f} \t{z:.0f}' )
 
-        time.sleep_ms(1)
+        # Less than a hop is left in the FIFO, so after one hop period
+        # at least one whole hop is ready. No polling in between
+        time.sleep_us(hop_length * sample_period_us)
 
 
 if __name__ == '__main__':
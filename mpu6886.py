@@ -11,8 +11,10 @@ MicroPython I2C driver for MPU6886 6-axis motion tracking device
 __version__ = "0.2.0-dev"
 
 # pylint: disable=import-error
+import array
 import struct
 import time
+import micropython
 from machine import I2C, Pin
 from micropython import const
 # pylint: enable=import-error
@@ -36,8 +38,11 @@ _GYRO_YOUT_L = const(0x46)
 _GYRO_ZOUT_H = const(0x47)
 _GYRO_ZOUT_L = const(0x48)
 _PWR_MGMT_1 = const(0x6b)
+_FIFO_R_W = const(0x74)
 _WHO_AM_I = const(0x75)
 
+_FIFO_SIZE = const(1024)
+
 ACCEL_FS_SEL_2G = const(0b00000000)
 ACCEL_FS_SEL_4G = const(0b00001000)
 ACCEL_FS_SEL_8G = const(0b00010000)
@@ -48,6 +53,13 @@ _ACCEL_SO_4G = 8192 # 1 / 8192 ie. 0.122 mg / digit
 _ACCEL_SO_8G = 4096 # 1 / 4096 ie. 0.244 mg / digit
 _ACCEL_SO_16G = 2048 # 1 / 2048 ie. 0.488 mg / digit
 
+_ACCEL_SO_TABLE = {
+    ACCEL_FS_SEL_2G: _ACCEL_SO_2G,
+    ACCEL_FS_SEL_4G: _ACCEL_SO_4G,
+    ACCEL_FS_SEL_8G: _ACCEL_SO_8G,
+    ACCEL_FS_SEL_16G: _ACCEL_SO_16G,
+}
+
 GYRO_FS_SEL_250DPS = const(0b00000000)
 GYRO_FS_SEL_500DPS = const(0b00001000)
 GYRO_FS_SEL_1000DPS = const(0b00010000)
@@ -58,6 +70,13 @@ _GYRO_SO_500DPS = 62.5
 _GYRO_SO_1000DPS = 32.8
 _GYRO_SO_2000DPS = 16.4
 
+_GYRO_SO_TABLE = {
+    GYRO_FS_SEL_250DPS: _GYRO_SO_250DPS,
+    GYRO_FS_SEL_500DPS: _GYRO_SO_500DPS,
+    GYRO_FS_SEL_1000DPS: _GYRO_SO_1000DPS,
+    GYRO_FS_SEL_2000DPS: _GYRO_SO_2000DPS,
+}
+
 _TEMP_SO = 326.8
 _TEMP_OFFSET = 25
 
@@ -66,6 +85,66 @@ SF_M_S2 = 9.80665 # 1 g = 9.80665 m/s2 ie. standard gravity
 SF_DEG_S = 1
 SF_RAD_S = 0.017453292519943 # 1 deg/s is 0.017453292519943 rad/s
 
+@micropython.viper
+def _deint(buf: ptr8, xs: ptr16, ys: ptr16, zs: ptr16, samples: int, stride: int):
+    # Big-endian int16 into native order. A ptr16 store keeps the low 16 bits,
+    # so the values read back correctly signed from an array('h')
+    offset = 0
+    for i in range(samples):
+        xs[i] = (buf[offset] << 8) | buf[offset+1]
+        ys[i] = (buf[offset+2] << 8) | buf[offset+3]
+        zs[i] = (buf[offset+4] << 8) | buf[offset+5]
+        offset += stride
+
+@micropython.viper
+def _deint_xyz(buf: ptr8, xyz: ptr16, samples: int, stride: int):
+    # Like _deint(), but into a single X,Y,Z,X,Y,Z... array
+    offset = 0
+    o = 0
+    for i in range(samples):
+        xyz[o] = (buf[offset] << 8) | buf[offset+1]
+        xyz[o+1] = (buf[offset+2] << 8) | buf[offset+3]
+        xyz[o+2] = (buf[offset+4] << 8) | buf[offset+5]
+        offset += stride
+        o += 3
+
+@micropython.viper
+def _sum_xyz(buf: ptr8, sums: ptr32, samples: int, stride: int):
+    # Sum of each axis as int32, without storing the samples
+    sx = 0
+    sy = 0
+    sz = 0
+    offset = 0
+    for i in range(samples):
+        x = (buf[offset] << 8) | buf[offset+1]
+        if x >= 0x8000:
+            x -= 0x10000
+        y = (buf[offset+2] << 8) | buf[offset+3]
+        if y >= 0x8000:
+            y -= 0x10000
+        z = (buf[offset+4] << 8) | buf[offset+5]
+        if z >= 0x8000:
+            z -= 0x10000
+        sx += x
+        sy += y
+        sz += z
+        offset += stride
+    sums[0] = sx
+    sums[1] = sy
+    sums[2] = sz
+
+def _is_int16(buf):
+    # The kernels store through ptr16. Other item sizes would be decoded
+    # wrong, or written out of bounds for 1-byte buffers
+    if isinstance(buf, (bytes, bytearray)):
+        return False
+    try:
+        return memoryview(buf).itemsize == 2
+    except TypeError:
+        return False # no buffer protocol, like list
+    except AttributeError:
+        return True # port without memoryview.itemsize
+
 class MPU6886:
     """Class which provides interface to MPU6886 6-axis motion tracking device."""
     def __init__(
@@ -76,6 +155,10 @@ class MPU6886:
     ):
         self.i2c = i2c
         self.address = address
+        self._char_buf = bytearray(1)
+        self._short_buf = bytearray(2)
+        self._three_shorts_buf = bytearray(6)
+        self._fifo_cnt_buf = bytearray(2)
 
         if 0x19 != self.whoami:
             raise RuntimeError("MPU6886 not found in I2C bus.")
@@ -89,8 +172,15 @@ class MPU6886:
         self._accel_sf = accel_sf
         self._gyro_sf = gyro_sf
         self._gyro_offset = gyro_offset
+        # scale factors, so that reading needs a multiply instead of a divide
+        self._accel_k = accel_sf / self._accel_so
+        self._gyro_k = gyro_sf / self._gyro_so
 
         self.bytes_per_sample = 8 # 3x2 bytes accelerometer, 2 bytes temperature
+        self._scratch = None # allocated on first read_samples_soa()
+        self._chunk_mv = None # set with set_buffer()
+        self._sums = array.array('i', (0, 0, 0))
+        self._deint_fmt = (0, None) # (samples, format) for deinterleave fallback
 
     @property
     def acceleration(self):
@@ -100,23 +190,21 @@ class MPU6886:
         return values in g if constructor was provided `accel_sf=SF_M_S2`
         parameter.
         """
-        so = self._accel_so
-        sf = self._accel_sf
+        k = self._accel_k
 
         xyz = self._register_three_shorts(_ACCEL_XOUT_H)
-        return tuple([value / so * sf for value in xyz])
+        return tuple([value * k for value in xyz])
 
     @property
     def gyro(self):
         """
         X, Y, Z radians per second as floats.
         """
-        so = self._gyro_so
-        sf = self._gyro_sf
+        k = self._gyro_k
         ox, oy, oz = self._gyro_offset
 
         xyz = self._register_three_shorts(_GYRO_XOUT_H)
-        xyz = [value / so * sf for value in xyz]
+        xyz = [value * k for value in xyz]
 
         xyz[0] -= ox
         xyz[1] -= oy
@@ -139,66 +227,62 @@ class MPU6886:
         return self._register_char(_WHO_AM_I)
 
     def calibrate(self, count=256, delay=0):
-        ox, oy, oz = (0.0, 0.0, 0.0)
-        self._gyro_offset = (0.0, 0.0, 0.0)
-        n = float(count)
+        # Sum raw readings as ints, scale once at the end
+        sx, sy, sz = (0, 0, 0)
+        n = count
 
         while count:
             time.sleep_ms(delay)
-            gx, gy, gz = self.gyro
-            ox += gx
-            oy += gy
-            oz += gz
+            gx, gy, gz = self._register_three_shorts(_GYRO_XOUT_H)
+            sx += gx
+            sy += gy
+            sz += gz
             count -= 1
 
-        self._gyro_offset = (ox / n, oy / n, oz / n)
+        k = self._gyro_k / n
+        self._gyro_offset = (sx * k, sy * k, sz * k)
         return self._gyro_offset
 
-    def _register_short(self, register, value=None, buf=bytearray(2)):
+    def _register_short(self, register, value=None):
+        buf = self._short_buf
         if value is None:
             self.i2c.readfrom_mem_into(self.address, register, buf)
-            return struct.unpack(">h", buf)[0]
+            value = int.from_bytes(buf, "big")
+            return value - 0x10000 if buf[0] & 0x80 else value
 
-        struct.pack_into(">h", buf, 0, value)
+        buf[0] = (value >> 8) & 0xff
+        buf[1] = value & 0xff
         return self.i2c.writeto_mem(self.address, register, buf)
 
-    def _register_three_shorts(self, register, buf=bytearray(6)):
+    def _register_three_shorts(self, register):
+        buf = self._three_shorts_buf
         self.i2c.readfrom_mem_into(self.address, register, buf)
         return struct.unpack(">hhh", buf)
 
-    def _register_char(self, register, value=None, buf=bytearray(1)):
+    def _register_char(self, register, value=None):
+        buf = self._char_buf
         if value is None:
             self.i2c.readfrom_mem_into(self.address, register, buf)
             return buf[0]
 
-        struct.pack_into("<b", buf, 0, value)
+        buf[0] = value & 0xff
         return self.i2c.writeto_mem(self.address, register, buf)
 
     def _accel_fs(self, value):
+        if value not in _ACCEL_SO_TABLE:
+            raise ValueError("Invalid accelerometer full scale")
         self._register_char(_ACCEL_CONFIG, value)
 
         # Return the sensitivity divider
-        if ACCEL_FS_SEL_2G == value:
-            return _ACCEL_SO_2G
-        elif ACCEL_FS_SEL_4G == value:
-            return _ACCEL_SO_4G
-        elif ACCEL_FS_SEL_8G == value:
-            return _ACCEL_SO_8G
-        elif ACCEL_FS_SEL_16G == value:
-            return _ACCEL_SO_16G
+        return _ACCEL_SO_TABLE[value]
 
     def _gyro_fs(self, value):
+        if value not in _GYRO_SO_TABLE:
+            raise ValueError("Invalid gyro full scale")
         self._register_char(_GYRO_CONFIG, value)
 
         # Return the sensitivity divider
-        if GYRO_FS_SEL_250DPS == value:
-            return _GYRO_SO_250DPS
-        elif GYRO_FS_SEL_500DPS == value:
-            return _GYRO_SO_500DPS
-        elif GYRO_FS_SEL_1000DPS == value:
-            return _GYRO_SO_1000DPS
-        elif GYRO_FS_SEL_2000DPS == value:
-            return _GYRO_SO_2000DPS
+        return _GYRO_SO_TABLE[value]
 
     def fifo_enable(self, enable):
 
@@ -216,6 +300,9 @@ class MPU6886:
         GYRO_FIFO_EN = 4
         ACCEL_FIFO_EN = 3
 
+        # NOTE: unlike MPU6050, there is no TEMP_FIFO_EN bit.
+        # Temperature is always written to the FIFO with the accel/gyro data,
+        # so each sample costs 8 bytes over the bus, not 6
         value = self._register_char(REG_FIFO_EN)
         value |= (1 << ACCEL_FIFO_EN)
         self._register_char(REG_FIFO_EN, value)
@@ -289,33 +376,160 @@ class MPU6886:
         Return the number of samples ready in the FIFO
         """
         REG_FIFO_COUNTH = 0x72
-        buf = bytearray(2)
+        buf = self._fifo_cnt_buf
         self.i2c.readfrom_mem_into(self.address, REG_FIFO_COUNTH, buf)
-        fifo_bytes = struct.unpack('>H', buf)[0]
+        fifo_bytes = (buf[0] << 8) | buf[1]
         fifo_count = fifo_bytes // self.bytes_per_sample
         return fifo_count
 
-    def read_samples_into(self, buf):
+    def set_buffer(self, buf):
+        """
+        Set the default buffer for read_samples_into() and read_available()
+
+        A memoryview over buf is kept, so no new view is made per read.
+        """
+        self._chunk_mv = memoryview(buf)
+
+    def _get_buffer(self, buf):
+        if buf is not None:
+            return buf
+        if self._chunk_mv is None:
+            raise ValueError("No buffer given, and none set with set_buffer()")
+        return self._chunk_mv
+
+    def read_samples_into(self, buf=None):
         """
         Read accelerometer samples from the FIFO
 
+        If buf is not given, the buffer from set_buffer() is used.
         NOTE: caller is responsible for ensuring that enough samples are ready.
         Typically by calling get_fifo_count() first
         """
+        buf = self._get_buffer(buf)
         n_bytes = len(buf)
         if (n_bytes % self.bytes_per_sample) != 0:
-            raise ValueError("Buffer should be a multiple of 6")
+            raise ValueError("Buffer should be a multiple of bytes_per_sample")
         samples = n_bytes // self.bytes_per_sample
-        if n_bytes > 1024:
+        if n_bytes > _FIFO_SIZE:
             raise ValueError("Requested samples exceeds FIFO capacity")
 
-        REG_FIFO_R_W = 0x74
-        self.i2c.readfrom_mem_into(self.address, REG_FIFO_R_W, buf)
+        self.i2c.readfrom_mem_into(self.address, _FIFO_R_W, buf)
+
+    def read_available(self, buf=None, multiple=1):
+        """
+        Read as many samples as are ready in the FIFO, up to the size of buf
+
+        All samples are read in a single burst, after one FIFO count read.
+        With multiple=hop_length, only whole hops are read, and the rest
+        stays in the FIFO for the next call.
+        If buf is not given, the buffer from set_buffer() is used.
+        Returns the number of samples read. Only the first
+        samples*bytes_per_sample bytes of buf are written.
+        """
+        buf = self._get_buffer(buf)
+        if not isinstance(buf, memoryview):
+            buf = memoryview(buf)
+        max_samples = len(buf) // self.bytes_per_sample
+        samples = min(self.get_fifo_count(), max_samples)
+        samples -= samples % multiple
+        if samples:
+            n_bytes = samples * self.bytes_per_sample
+            self.i2c.readfrom_mem_into(self.address, _FIFO_R_W, buf[:n_bytes])
+        return samples
+
+    def read_samples_soa(self, xs, ys, zs):
+        """
+        Read accelerometer samples from the FIFO directly into X,Y,Z arrays
 
-    def deinterleave_samples(self, buf : bytearray,
-            xs, ys, zs):
+        One sample is read per element of the arrays,
+        see deinterleave_samples() for the supported types.
+        NOTE: caller is responsible for ensuring that enough samples are ready.
+        Typically by calling get_fifo_count() first
         """
-        Convert raw bytes into X,Y,Z int16 arrays
+        samples = len(xs)
+        assert len(ys) == samples
+        assert len(zs) == samples
+        n_bytes = samples * self.bytes_per_sample
+        if n_bytes > _FIFO_SIZE:
+            raise ValueError("Requested samples exceeds FIFO capacity")
+
+        if self._scratch is None:
+            self._scratch = memoryview(bytearray(_FIFO_SIZE))
+
+        chunk = self._scratch[:n_bytes]
+        self.i2c.readfrom_mem_into(self.address, _FIFO_R_W, chunk)
+        self.deinterleave_samples(chunk, xs, ys, zs)
+
+    def read_and_mean(self, buf=None):
+        """
+        Read accelerometer samples from the FIFO and return the X,Y,Z means
+
+        Reads one sample per bytes_per_sample bytes of buf, like
+        read_samples_into(), and returns the raw int16 means as floats.
+        No X,Y,Z arrays are needed.
+        """
+        buf = self._get_buffer(buf)
+        samples = len(buf) // self.bytes_per_sample
+        if samples < 1:
+            raise ValueError("Buffer should be a non-zero multiple of bytes_per_sample")
+        self.read_samples_into(buf)
+
+        sums = self._sums
+        _sum_xyz(buf, sums, samples, self.bytes_per_sample)
+        return (sums[0] / samples, sums[1] / samples, sums[2] / samples)
+
+    def deinterleave_samples_aosoa(self, buf, xyz):
+        """
+        Convert raw bytes into a single int16 array of X,Y,Z triplets
+
+        xyz must be an array('h') with 3 elements per sample.
+        Keeps the axes of each sample next to each other,
+        for processing that needs all three, like the magnitude.
+        """
+        assert (len(buf) % self.bytes_per_sample) == 0
+        samples = len(buf) // self.bytes_per_sample
+        assert len(xyz) == 3*samples
+        if not _is_int16(xyz):
+            raise ValueError("xyz should be an array('h')")
+
+        # NOTE: temperature (follows z) is ignored
+        _deint_xyz(buf, xyz, samples, self.bytes_per_sample)
+
+    def make_deinterleaver(self, samples):
+        """
+        Return a function deinterleave(buf, xs, ys, zs) for a fixed number of samples
+
+        Same as deinterleave_samples(), with the sizes computed up front.
+        buf must hold samples*bytes_per_sample bytes,
+        and xs, ys, zs must have samples elements.
+        """
+        stride = self.bytes_per_sample
+        n_bytes = samples * stride
+        deint = _deint
+        is_int16 = _is_int16
+
+        def deinterleave(buf, xs, ys, zs):
+            # the kernel does no bounds checking
+            assert len(buf) == n_bytes
+            assert len(xs) == samples
+            assert len(ys) == samples
+            assert len(zs) == samples
+            if is_int16(xs) and is_int16(ys) and is_int16(zs):
+                deint(buf, xs, ys, zs, samples, stride)
+            else:
+                self.deinterleave_samples(buf, xs, ys, zs)
+
+        return deinterleave
+
+    def deinterleave_samples(self, buf, xs, ys, zs):
+        """
+        Convert raw bytes into X,Y,Z int16 values
+
+        buf can be a bytearray or a memoryview of one.
+        When xs, ys, zs are all array('h') a fast viper kernel is used.
+        Other sequences, like list or array('i'), are filled with a slower path.
+        NOTE: on ports without memoryview.itemsize, any buffer other than
+        bytes/bytearray is assumed to be int16.
         """
         assert (len(buf) % self.bytes_per_sample) == 0
         samples = len(buf) // self.bytes_per_sample
@@ -323,11 +537,24 @@ class MPU6886:
         assert len(ys) == samples
         assert len(zs) == samples
 
-        #view = memoryview(buf)
-        for i in range(samples):
-            # NOTE: temperature (follows z) is ignored
-            x, y, z = struct.unpack_from('>hhh', buf, i*self.bytes_per_sample)
-            xs[i] = x
-            ys[i] = y
-            zs[i] = z
+        # NOTE: temperature (follows z) is ignored
+        if _is_int16(xs) and _is_int16(ys) and _is_int16(zs):
+            _deint(buf, xs, ys, zs, samples, self.bytes_per_sample)
+        else:
+            # Any other sequence, possibly mixed,
+            # so assign per element instead of by slice.
+            # Unpack the whole chunk at once and pick out every axis
+            step = self.bytes_per_sample // 2
+            n, fmt = self._deint_fmt
+            if n != samples:
+                # also unpacks temperature, as not all MicroPython versions support 'x' padding
+                fmt = '>%dh' % (samples * step)
+                self._deint_fmt = (samples, fmt)
+            values = struct.unpack_from(fmt, buf)
+            o = 0
+            for i in range(samples):
+                xs[i] = values[o]
+                ys[i] = values[o+1]
+                zs[i] = values[o+2]
+                o += step
 